@@ -1,14 +1,17 @@
 #! -*- coding: utf-8 -*-
 
-import struct
 import os
-import six
-import codecs
-import math
+import mmap
 import logging
 import re
 import glob
 import argparse
+import itertools
+import multiprocessing as mp
+from collections import Counter, deque
+from operator import itemgetter
+import numpy as np
+from numba import njit
 
 logging.basicConfig(level=logging.INFO, format=u'%(asctime)s - %(levelname)s - %(message)s')
 
@@ -37,18 +40,30 @@ class Progress:
         self.logger = logging.getLogger()
 
     def __iter__(self):
-        for i, j in enumerate(self.iterator):
-            if (i + 1) % self.period == 0:
-                self.logger.info(self._format_ % (i + 1))
+        next_log = self.period
+        for i, j in enumerate(self.iterator, 1):
+            if i == next_log:
+                self.logger.info(self._format_ % i)
+                next_log += self.period
             yield j
 
 
+def key_dtype(bits, order):
+    """拼接order个bits位编号得到的键所用的dtype：放得进64位时用np.uint64，否则退化为Python整数(object)
+    """
+    return np.dtype(np.uint64) if bits * order <= 64 else np.dtype(object)
+
+
 class KenlmNgrams:
     """加载Kenlm的ngram统计结果
     vocab_file: Kenlm统计出来的词(字)表；
     ngram_file: Kenlm统计出来的ngram表；
     order: 统计ngram时设置的n，必须跟ngram_file对应；
     min_count: 自行设置的截断频数。
+    ngrams中的键是把各字编号依次拼接(每个编号占bits位)得到的整数，可用decode转回字符串。
+    bits * order超过64时，键改用Python整数运算，结果不变，只是慢一些。
+    raw_chars是字表中各字未解码的bytes；chars与之一一对应，初始全为None，
+    只有decode用到的字才会被解码填入。
     """
 
     def __init__(self, vocab_file, ngram_file, order, min_count):
@@ -57,51 +72,84 @@ class KenlmNgrams:
         self.order = order
         self.min_count = min_count
         self.read_chars()
+        self.bits = max((len(self.chars) - 1).bit_length(), 1)
         self.read_ngrams()
 
     def read_chars(self):
-        f = open(self.vocab_file)
-        chars = f.read()
-        f.close()
-        chars = chars.split('\x00')
-        self.chars = [i.decode('utf-8') if six.PY2 else i for i in chars]
+        """字表以\\x00分隔，按字节切分后不立即解码，用到时再由decode逐个解码
+        """
+        with open(self.vocab_file, 'rb') as f:
+            self.raw_chars = f.read().split(b'\x00')
+        self.chars = [None] * len(self.raw_chars)
 
     def read_ngrams(self):
         """读取思路参考https://github.com/kpu/kenlm/issues/201
+        每条记录是order个int32的字编号，再加一个int64的频数。
+        文件通过mmap直接映射为NumPy结构化数组，截断后的记录才复制到内存中。
         """
         self.ngrams = [{} for _ in range(self.order)]
-        self.total = 0
-        size_per_item = self.order * 4 + 8
-
-        def ngrams():
-            with open(self.ngram_file, 'rb') as f:
-                while True:
-                    s = f.read(size_per_item)
-                    if len(s) == size_per_item:
-                        n = self.unpack('l', s[-8:])
-                        yield s, n
-                    else:
-                        break
-
-        for s, n in Progress(ngrams(), 100000, desc=u'loading ngrams'):
-            if n >= self.min_count:
-                self.total += n
-                c = [self.unpack('i', s[j * 4: (j + 1) * 4]) for j in range(self.order)]
-                c = ''.join([self.chars[j] for j in c if j > 2])
-                for j in range(len(c)):
-                    self.ngrams[j][c[:j + 1]] = self.ngrams[j].get(c[:j + 1], 0) + n
-
-    def unpack(self, t, s):
-        return struct.unpack(t, s)[0]
+        dtype = np.dtype([('ids', np.int32, (self.order,)), ('count', np.int64)])
+        with open(self.ngram_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < dtype.itemsize:
+                records = np.zeros(0, dtype)
+            else:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    view = np.frombuffer(mm, dtype=dtype, count=len(mm) // dtype.itemsize)
+                    try:
+                        records = view[view['count'] >= self.min_count]  # 布尔索引会复制，之后即可释放mmap
+                    finally:
+                        del view  # mmap关闭前必须先释放指向它的视图
+        self.total = int(records['count'].sum())
+        ids, counts = records['ids'], records['count']
+        # 把特殊标记(<unk>、<s>、</s>，编号0~2)挪到每行末尾，前面只留下真正的字
+        valid = ids > 2
+        ids = np.take_along_axis(ids, np.argsort(~valid, axis=1, kind='stable'), axis=1)
+        lengths = valid.sum(axis=1)
+        # 逐位拼接出各长度前缀的整数键，再按键分组累加频数
+        dtype = key_dtype(self.bits, self.order)
+        keys = np.zeros(len(ids), dtype)
+        for j in Progress(range(self.order), 1, desc=u'loading ngrams'):
+            keys = (keys << np.array(self.bits, dtype)) | ids[:, j].astype(dtype)
+            mask = lengths > j
+            prefixes, inverse = np.unique(keys[mask], return_inverse=True)
+            sums = np.bincount(inverse.ravel(), weights=counts[mask], minlength=len(prefixes))
+            self.ngrams[j] = dict(zip(prefixes.tolist(), sums.astype(np.int64).tolist()))
+
+    def decode(self, keys):
+        """把一批整数键转回ngram字符串
+        先用移位一次性拆出所有字编号，只解码其中出现过的字，再逐行拼接。
+        """
+        dtype = key_dtype(self.bits, self.order)
+        keys = np.array(list(keys), dtype)
+        shifts = np.array([self.bits * j for j in range(self.order - 1, -1, -1)], dtype)
+        ids = ((keys[:, None] >> shifts) & np.array((1 << self.bits) - 1, dtype)).astype(np.int64)
+        used = np.unique(ids)
+        table = np.full(len(self.chars), u'', dtype=object)  # 编号0只是键中的空位，对应空串
+        for k in used[used > 0].tolist():
+            if self.chars[k] is None:
+                self.chars[k] = self.raw_chars[k].decode('utf-8')
+            table[k] = self.chars[k]
+        return [''.join(c) for c in table[ids].tolist()]
+
+
+def write_lines(lines, filename, buffer_size=1 << 20):
+    """将若干行文本以utf-8写到文件中
+    先在缓冲区中攒够buffer_size字节再统一写入，减少write调用次数。
+    """
+    with open(filename, 'wb') as f:
+        buf = bytearray()
+        for line in lines:
+            buf += line.encode('utf-8')
+            if len(buf) >= buffer_size:
+                f.write(buf)
+                buf.clear()
+        f.write(buf)
 
 
 def write_corpus(texts, filename):
     """将语料写到文件中，词与词(字与字)之间用空格隔开
     """
-    with codecs.open(filename, 'w', encoding='utf-8') as f:
-        for s in Progress(texts, 10000, desc=u'exporting corpus'):
-            s = ' '.join(s) + '\n'
-            f.write(s)
+    write_lines((' '.join(s) + '\n' for s in Progress(texts, 10000, desc=u'exporting corpus')), filename)
 
 
 def count_ngrams(corpus_file, order, vocab_file, ngram_file, memory=0.5):
@@ -116,10 +164,12 @@ def count_ngrams(corpus_file, order, vocab_file, ngram_file, memory=0.5):
         raise ValueError('Failed to count ngrams by KenLM.')
 
 
-def filter_ngrams(ngrams, total, min_pmi=1):
+def filter_ngrams(ngrams, total, bits, min_pmi=1):
     """通过互信息过滤ngrams，只保留“结实”的ngram。
     pmi表示凝固度
     min_pmi 的值类似 [0, 2, 4, 6] 表示不同长度的ngram的凝固度的阈值
+    ngrams的键是KenlmNgrams拼接出来的整数，bits必须与KenlmNgrams.bits一致，
+    切分ngram就是对键做移位和截取。返回的也是整数键的集合。
     """
     order = len(ngrams)
     if hasattr(min_pmi, '__iter__'):
@@ -128,70 +178,354 @@ def filter_ngrams(ngrams, total, min_pmi=1):
         min_pmi = [min_pmi] * order
     output_ngrams = set()
     total = float(total)
+    dtype = key_dtype(bits, order)
     for i in range(order - 1, 0, -1):
-        for w, v in ngrams[i].items():
-            pmi = min([
-                total * v / (ngrams[j].get(w[:j + 1], total) * ngrams[i - j - 1].get(w[j + 1:], total))
-                for j in range(i)
-            ])
-            if math.log(pmi) >= min_pmi[i]:
-                output_ngrams.add(w)
+        words = list(ngrams[i])
+        n = len(words)
+        if n == 0:
+            continue
+        keys = np.array(words, dtype)
+        counts = np.fromiter(ngrams[i].values(), np.int64, n)
+        # 逐个切分点查出左右两部分的频数，组成(n, i)的矩阵，再统一计算
+        left = np.empty((n, i), np.int64)
+        right = np.empty((n, i), np.int64)
+        for j in range(i):
+            shift = bits * (i - j)
+            left_keys = (keys >> np.array(shift, dtype)).tolist()
+            right_keys = (keys & np.array((1 << shift) - 1, dtype)).tolist()
+            left[:, j] = np.fromiter((ngrams[j].get(k, total) for k in left_keys), np.int64, n)
+            right[:, j] = np.fromiter((ngrams[i - j - 1].get(k, total) for k in right_keys), np.int64, n)
+        pmi = (np.log(total) + np.log(counts)[:, None] - np.log(left) - np.log(right)).min(axis=1)
+        output_ngrams.update(w for w, keep in zip(words, pmi >= min_pmi[i]) if keep)
     return output_ngrams
 
 
-class SimpleTrie:
-    """通过Trie树结构，来搜索ngrams组成的连续片段
-    """
-
-    def __init__(self):
-        self.dic = {}
-        self.end = True
+@njit(cache=True)
+def _grow(arr, new_size, fill):
+    new_arr = np.empty(new_size, arr.dtype)
+    new_arr[:len(arr)] = arr
+    new_arr[len(arr):] = fill
+    return new_arr
 
-    def add_word(self, word):
-        _ = self.dic
-        for c in word:
-            if c not in _:
-                _[c] = {}
-            _ = _[c]
-        _[self.end] = word
 
-    def tokenize(self, sent):  # 通过最长联接的方式来对句子进行分词
-        result = []
-        start, end = 0, 1
-        for i, c1 in enumerate(sent):
-            _ = self.dic
+@njit(cache=True)
+def _unlink(t, next_free, prev_free, head, tail, size):
+    """把空位t从空位链表中摘除，返回新的(head, tail)
+    """
+    p, n = prev_free[t], next_free[t]
+    if p >= 0:
+        next_free[p] = n
+    else:
+        head = n
+    if n < size:
+        prev_free[n] = p
+    else:
+        tail = p
+    return head, tail
+
+
+@njit(cache=True)
+def build_double_array(row_start, child_code, child_node, max_trials=16):
+    """把CSR形式的Trie转为双数组，返回(base, check, 各节点对应的状态)
+    节点i的子节点为child_node[row_start[i]: row_start[i + 1]]，编号按child_code递增，
+    且父节点的编号总小于子节点。
+    状态t = base[s] + code是s的子节点，当且仅当check[t] == s；check为-1表示空位。
+    所有空位串成双向链表，找base时只遍历空位。先从链表头开始试，试了max_trials个空位仍未找到时，
+    改从frontier(上一个这样的节点放置的位置)往后找。frontier之后的区域比较稀疏，很快就能找到，
+    而frontier只会向后移动，所以总体接近线性。
+    """
+    num_nodes = len(row_start) - 1
+    size = max(2 * num_nodes, 256)
+    base = np.zeros(size, np.int32)
+    check = np.full(size, -1, np.int32)
+    next_free = np.arange(1, size + 1)  # 指向size表示链表结束
+    prev_free = np.arange(-1, size - 1)
+    head, tail = 1, size - 1  # 0号位置是根节点
+    prev_free[1] = -1
+    states = np.zeros(num_nodes, np.int64)
+    used = 1
+    frontier = 1
+    for node in range(num_nodes):
+        lo, hi = row_start[node], row_start[node + 1]
+        if lo == hi:
+            continue
+        first, last = child_code[lo], child_code[hi - 1]
+        p = head
+        trials = 0
+        while True:
+            if trials == max_trials:  # 改从frontier开始找
+                p = max(frontier, first + 1)
+                while p < size and check[p] != -1:
+                    p += 1
+                trials += 1
+            elif p <= first:  # 保证base至少为1
+                p = next_free[p]
+                trials += 1
+                continue
+            if p + last - first >= size:  # 容量不够时翻倍扩充，新增的空位接到链表末尾
+                new_size = max(2 * size, p + last - first + 1)
+                base = _grow(base, new_size, 0)
+                check = _grow(check, new_size, -1)
+                next_free = _grow(next_free, new_size, 0)
+                prev_free = _grow(prev_free, new_size, 0)
+                next_free[size:] = np.arange(size + 1, new_size + 1)
+                prev_free[size:] = np.arange(size - 1, new_size - 1)
+                prev_free[size] = tail
+                if tail < 0:
+                    head = size
+                tail = new_size - 1
+                size = new_size
+            b = p - first
+            ok = True
+            for q in range(lo, hi):
+                if check[b + child_code[q]] != -1:
+                    ok = False
+                    break
+            if ok:
+                break
+            p = next_free[p]
+            trials += 1
+        if trials > max_trials:
+            frontier = max(frontier, p)
+        s = states[node]
+        base[s] = b
+        for q in range(lo, hi):
+            t = b + child_code[q]
+            check[t] = s
+            head, tail = _unlink(t, next_free, prev_free, head, tail, size)
+            states[child_node[q]] = t
+        used = max(used, b + last + 1)
+    return base[:used].copy(), check[:used].copy(), states
+
+
+@njit(cache=True)
+def tokenize_double_array(codes, offsets, code_map, base, check, terminal):
+    """在双数组Trie上通过最长联接的方式切分一批句子，返回各片段的(句子序号, start, end)
+    codes: 整批句子拼接起来的码位数组(np.int32)；
+    offsets: 第i个句子位于codes[offsets[i]: offsets[i + 1]]；
+    其余参数即DoubleArrayTrie的各个数组。
+    注意不能在匹配到ngram后直接跳到其末尾：相互重叠的ngram要联接成一个片段，
+    这样才能得到长度超过order的候选词。每个位置最多向后匹配order个字，
+    所以整体仍是线性的。
+    """
+    size = len(check)
+    spans = np.empty((len(codes) + len(offsets), 3), np.int64)
+    k = 0
+    for s in range(len(offsets) - 1):
+        lo, hi = offsets[s], offsets[s + 1]
+        start, end = lo, lo + 1
+        for i in range(lo, hi):
             if i == end:
-                result.append(sent[start: end])
+                spans[k, 0] = s
+                spans[k, 1] = start
+                spans[k, 2] = end
+                k += 1
                 start, end = i, i + 1
-            for j, c2 in enumerate(sent[i:]):
-                if c2 in _:
-                    _ = _[c2]
-                    if self.end in _:
-                        if i + j + 1 > end:
-                            end = i + j + 1
-                else:
+            state = 0
+            for j in range(i, hi):
+                c = codes[j]
+                if c < 0 or c >= len(code_map) or code_map[c] == 0:
+                    break
+                t = base[state] + code_map[c]
+                if t >= size or check[t] != state:
                     break
-        result.append(sent[start: end])
-        return result
+                state = t
+                if (terminal[state >> 3] >> (state & 7)) & 1 and j + 1 > end:
+                    end = j + 1
+        spans[k, 0] = s
+        spans[k, 1] = start
+        spans[k, 2] = min(end, hi)  # 空句子得到一个空片段
+        k += 1
+    return spans[:k]
+
+
+@njit(cache=True)
+def pack_spans(codes, spans, code_map, bits):
+    """把各片段打包成一个uint64键，相同的片段得到相同的键，便于用np.unique分组统计
+    最高3位存片段长度，以区分不同长度的片段；单字片段存其码位，多字片段的每个字用bits位存字母表编号。
+    空的、太长的或含字母表以外的字的多字片段，键为0，需另行处理。
+    """
+    max_len = min(7, 61 // bits)
+    keys = np.zeros(len(spans), np.uint64)
+    for k in range(len(spans)):
+        start, end = spans[k, 1], spans[k, 2]
+        n = end - start
+        if n == 1:
+            keys[k] = (np.uint64(1) << np.uint64(61)) | np.uint64(codes[start])
+        elif 1 < n <= max_len:
+            key = np.uint64(0)
+            for j in range(start, end):
+                c = codes[j]
+                if c < 0 or c >= len(code_map) or code_map[c] == 0:
+                    break
+                key = (key << np.uint64(bits)) | np.uint64(code_map[c])
+            else:
+                keys[k] = (np.uint64(n) << np.uint64(61)) | key
+    return keys
+
+
+class DoubleArrayTrie:
+    """通过Trie树结构，来搜索ngrams组成的连续片段
+    Trie树以双数组的形式存放在几个连续的NumPy数组中：
+    code_map: 字符码位到字母表编号(从1开始)的映射，0表示不在字母表中；
+    bits: 字母表编号所占的位数；
+    base、check: 状态s经编号c转移到t = base[s] + c，当且仅当check[t] == s；
+    terminal: 按位存放的标记，状态是否为某个ngram的结尾。
+    """
+
+    def __init__(self, words):
+        words = set(words)
+        # 按字出现的次数从多到少编号，常用字编号小，各节点的子节点编号更集中，双数组更紧凑
+        char_counts = Counter(u''.join(words))
+        alphabet = sorted(char_counts, key=lambda c: (-char_counts[c], c))  # 次数相同时按字排序，保证编号固定
+        self.code_map = np.zeros(max(map(ord, alphabet)) + 1 if alphabet else 1, np.int32)
+        self.code_map[[ord(c) for c in alphabet]] = np.arange(1, len(alphabet) + 1, dtype=np.int32)
+        self.bits = max(len(alphabet).bit_length(), 1)  # 每个字母表编号所占的位数
+        # 把每个词转写成由编号组成的字符串，所有前缀排序后即为Trie的先序遍历，以此给节点编号(根节点为0)
+        table = {ord(c): chr(i) for i, c in enumerate(alphabet, 1)}
+        words = [w.translate(table) for w in words]
+        nodes = sorted(set(w[:d] for w in words for d in range(1, len(w) + 1)))
+        ids = {u'': 0}
+        ids.update(zip(nodes, range(1, len(nodes) + 1)))
+        num_nodes = len(ids)
+        parents = np.fromiter((ids[w[:-1]] for w in nodes), np.int64, num_nodes - 1)
+        child_code = np.fromiter((ord(w[-1]) for w in nodes), np.int32, num_nodes - 1)
+        # 按父节点分组(稳定排序，组内仍按编号递增)，得到CSR形式的Trie
+        order = np.argsort(parents, kind='stable')
+        row_start = np.zeros(num_nodes + 1, np.int64)
+        row_start[1:] = np.cumsum(np.bincount(parents, minlength=num_nodes))
+        # 再转为双数组
+        logging.getLogger().info(u'build ngram trie - %s nodes' % num_nodes)
+        self.base, self.check, states = build_double_array(row_start, child_code[order], order + 1)
+        is_terminal = np.zeros(len(self.check), np.bool_)
+        is_terminal[states[[ids[w] for w in words]]] = True
+        self.terminal = np.packbits(is_terminal, bitorder='little')
+
+    def tokenize(self, sent):  # 通过最长联接的方式来对句子进行分词
+        return self.tokenize_many([sent])
+
+    def tokenize_many(self, sents):  # 整批句子拼接后一次性切分，返回所有句子的片段
+        text, _, spans = self._tokenize_spans(sents)
+        return [text[s: e] for _, s, e in spans.tolist()]
+
+    def count_many(self, sents, weights):
+        """整批切分并统计片段频数，第i个句子的片段计weights[i]次
+        片段先打包成整数键，用np.unique和np.bincount分组累加，只有不同的片段才转为字符串。
+        """
+        text, codes, spans = self._tokenize_spans(sents)
+        keys = pack_spans(codes, spans, self.code_map, self.bits)
+        weights = np.asarray(weights, np.int64)[spans[:, 0]]
+        packed = keys != 0
+        uniq, first, inverse = np.unique(keys[packed], return_index=True, return_inverse=True)
+        sums = np.bincount(inverse.ravel(), weights=weights[packed], minlength=len(uniq))
+        words = (text[s: e] for _, s, e in spans[packed][first].tolist())
+        counts = Counter(dict(zip(words, sums.astype(np.int64).tolist())))
+        # 没能打包的片段逐个计数：只出现一次的句子直接用Counter.update，重复的句子才乘上次数
+        rest, weights = spans[~packed], weights[~packed]
+        counts.update([text[s: e] for _, s, e in rest[weights == 1].tolist()])
+        for (_, s, e), n in zip(rest[weights != 1].tolist(), weights[weights != 1].tolist()):
+            counts[text[s: e]] += n
+        return counts
+
+    def _tokenize_spans(self, sents):
+        text = u''.join(sents)
+        offsets = np.zeros(len(sents) + 1, np.int64)
+        offsets[1:] = np.cumsum([len(s) for s in sents])
+        codes = np.frombuffer(text.encode('utf-32-le'), np.int32)
+        spans = tokenize_double_array(codes, offsets, self.code_map, self.base, self.check, self.terminal)
+        return text, codes, spans
+
+
+_tokenizer = None  # 子进程中用于预分词的Trie树，由init_tokenizer设置
+
+
+def init_tokenizer(trie):
+    global _tokenizer
+    _tokenizer = trie
+
+
+def tokenize_batch(items):
+    """对一批(句子, 出现次数)预分词，返回(句子总数, 各片段的频数)
+    """
+    sents, weights = zip(*items)
+    return sum(weights), _tokenizer.count_many(sents, weights)
+
+
+def batched(iterator, size):
+    """把iterator按size条一组切分成列表
+    """
+    iterator = iter(iterator)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            break
+        yield batch
+
+
+def imap_bounded(pool, func, iterable, window):
+    """与pool.imap一样按提交顺序返回结果，但最多只有window个任务在排队，
+    不会像pool.imap那样预先把整个iterable读进内存
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def count_candidates(texts, trie, workers=1, batch_size=4096, min_count=0, prune_period=1000000):
+    """用trie对所有句子预分词并统计候选词频数
+    语料中常有大量重复的句子，每批句子先去重计数，批内相同的句子只预分词一次。
+    句子之间互不相关，workers > 1时分批交给进程池并行处理，再合并结果。
+    min_count >= 4时，每处理prune_period个句子就丢掉频数低于min_count // 4的候选词，
+    以控制内存。这种裁剪是近似的，之后仍要按min_count做最终的频数过滤；
+    各批结果总是按语料顺序合并，所以裁剪的结果不受进程调度影响。
+    """
+    batches = batched(Progress(texts, 1000, desc=u'discovering words'), batch_size)
+    batches = (list(Counter(batch).items()) for batch in batches)
+    if workers > 1:
+        with mp.Pool(workers, initializer=init_tokenizer, initargs=(trie,)) as pool:
+            results = imap_bounded(pool, tokenize_batch, batches, 2 * workers)
+            return merge_candidates(results, min_count, prune_period)
+    else:
+        init_tokenizer(trie)
+        return merge_candidates(map(tokenize_batch, batches), min_count, prune_period)
+
+
+def merge_candidates(results, min_count=0, prune_period=1000000):
+    """按顺序合并各批的(句子总数, 片段频数)，并按count_candidates的说明定期裁剪
+    """
+    candidates = Counter()
+    threshold = min_count // 4
+    seen, next_prune = 0, prune_period
+    for n, counts in results:
+        candidates.update(counts)
+        seen += n
+        if threshold > 0 and seen >= next_prune:
+            candidates = Counter({w: c for w, c in candidates.items() if c >= threshold})
+            next_prune = (seen // prune_period + 1) * prune_period
+    return candidates
+
+
+def _is_solid(word, ngrams, order):
+    """长度超过order的词，要求其中每个长度为order的片段都在ngrams中
+    """
+    return all(word[k: k + order] in ngrams for k in range(len(word) + 1 - order))
 
 
 def filter_vocab(candidates, ngrams, order):
     """通过与ngrams对比，排除可能出来的不牢固的词汇(回溯)
+    candidates是(词, 频数)的迭代器，逐个产出保留下来的(词, 频数)，不构造中间的dict。
     """
-    result = {}
-    for i, j in candidates.items():
-        if len(i) < 3:
-            result[i] = j
-        elif len(i) <= order and i in ngrams:
-            result[i] = j
-        elif len(i) > order:
-            flag = True
-            for k in range(len(i) + 1 - order):
-                if i[k: k + order] not in ngrams:
-                    flag = False
-            if flag:
-                result[i] = j
-    return result
+    ngrams = frozenset(ngrams)
+    for i, j in candidates:
+        if len(i) < 3 or (len(i) <= order and i in ngrams) or (len(i) > order and _is_solid(i, ngrams, order)):
+            yield i, j
+
+
+_CLEAN_RE = re.compile(u'[^\u4e00-\u9fa50-9a-zA-Z ]+')
 
 
 # 语料生成器，并且初步预处理语料
@@ -199,9 +533,11 @@ def filter_vocab(candidates, ngrams, order):
 def text_generator(file_path='/root/corpus/*/*.txt'):
     txts = glob.glob(file_path)
     for txt in txts:
-        d = codecs.open(txt, encoding='utf-8').read()
-        d = d.replace(u'\u3000', ' ').strip()
-        yield re.sub(u'[^\u4e00-\u9fa50-9a-zA-Z ]+', '\n', d)
+        with open(txt, encoding='utf-8', buffering=1 << 20) as f:  # 逐行读取，避免整个文件载入内存
+            for line in f:
+                line = line.replace(u'\u3000', ' ').strip()
+                if line:
+                    yield _CLEAN_RE.sub('\n', line)
 
 
 # ======= 算法构建完毕，下面开始执行完整的构建词库流程 =======
@@ -219,6 +555,7 @@ if __name__ == '__main__':
     parser.add_argument('--ngram_file', type=str, default='ngram_file.ngrams', required=False)
     parser.add_argument('--output_file', type=str, default='output_file.vocab', required=False)
     parser.add_argument('--memory', type=float, default=0.8, required=False)
+    parser.add_argument('--workers', type=int, default=mp.cpu_count(), required=False)
 
     args = parser.parse_args()
     load_texts_in_memory = args.load_texts_in_memory
@@ -230,6 +567,7 @@ if __name__ == '__main__':
     ngram_file = args.ngram_file  # ngram集保存的文件名
     output_file = args.output_file  # 最后导出的词表文件名
     memory = args.memory  # memory是占用内存比例，理论上不能超过可用内存比例
+    workers = args.workers  # 预分词时使用的进程数
     if load_texts_in_memory:
         texts = list(text_generator(file_path=file_path))
     else:
@@ -238,30 +576,21 @@ if __name__ == '__main__':
     write_corpus(texts, corpus_file)  # 将语料转存为文本
 
     count_ngrams(corpus_file, order, vocab_file, ngram_file, memory)  # 用Kenlm统计ngram
-    ngrams = KenlmNgrams(vocab_file, ngram_file, order, min_count)  # 加载ngram
-    ngrams = filter_ngrams(ngrams.ngrams, ngrams.total, [0, 2, 4, 6])  # 过滤ngram
-    ngtrie = SimpleTrie()  # 构建ngram的Trie树
-
-    for w in Progress(ngrams, 100000, desc=u'build ngram trie'):
-        _ = ngtrie.add_word(w)
+    kenlm_ngrams = KenlmNgrams(vocab_file, ngram_file, order, min_count)  # 加载ngram
+    ngrams = filter_ngrams(kenlm_ngrams.ngrams, kenlm_ngrams.total, kenlm_ngrams.bits, [0, 2, 4, 6])  # 过滤ngram
+    ngrams = set(kenlm_ngrams.decode(ngrams))  # 只把保留下来的ngram转回字符串
+    ngtrie = DoubleArrayTrie(ngrams)  # 构建ngram的Trie树
 
-    candidates = {}  # 得到候选词
-    for t in Progress(texts, 1000, desc='discovering words'):
-        for w in ngtrie.tokenize(t):  # 预分词
-            candidates[w] = candidates.get(w, 0) + 1
+    candidates = count_candidates(texts, ngtrie, workers, min_count=min_count)  # 预分词，得到候选词
 
-    print("完成预分词")
+    print("完成预分词，开始过滤并写入最终结果文件")
     # 频数过滤
-    candidates = {i: j for i, j in candidates.items() if j >= min_count}
-    print("完成频数过滤")
+    candidates = ((i, j) for i, j in candidates.items() if j >= min_count)
     # 互信息过滤(回溯)
     candidates = filter_vocab(candidates, ngrams, order)
-    print("完成互信息过滤，开始写入最终结果文件")
 
     # 输出结果文件
-    with codecs.open(output_file, 'w', encoding='utf-8') as f:
-        for i, j in sorted(candidates.items(), key=lambda s: -s[1]):
-            s = '%s %s\n' % (i, j)
-            f.write(s)
+    candidates = sorted(candidates, key=itemgetter(1), reverse=True)
+    write_lines(('%s %s\n' % (i, j) for i, j in candidates), output_file)
 
     print("成功！")